@@ -1,16 +1,23 @@
 # Lotus Notebook Python Runtime Setup
 # This script configures Python environment for Lotus Notebook
 
-# Configure matplotlib for inline display
-import matplotlib
-matplotlib.use('Agg')
-
 # Import required libraries
+import contextlib
+import os
 import sys
 import io
-import base64
+import importlib.metadata
 import json
+import html as html_module
 import traceback as traceback_module
+import weakref
+import functools
+import types
+from pathlib import Path
+
+# Configure matplotlib for inline display; the environment variable applies
+# whenever matplotlib is first imported, without importing it here
+os.environ.setdefault('MPLBACKEND', 'Agg')
 
 # Try to import markdown library for markdown rendering support
 try:
@@ -20,9 +27,122 @@ except ImportError:
     MARKDOWN_AVAILABLE = False
     print("Note: markdown library not available. Install with: pip install markdown")
 
+# Try to import pybase64 for SIMD-accelerated base64 encoding
+try:
+    import pybase64 as _b64
+except ImportError:
+    import base64 as _b64
+
+# Try to import orjson for faster output serialization
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+# Try to import zstandard for compressing cached results
+try:
+    import zstandard
+    ZSTANDARD_AVAILABLE = True
+except ImportError:
+    ZSTANDARD_AVAILABLE = False
+
 # Import re for simple markdown rendering
 import re
 
+def _dumps(obj):
+    """Serialize an object to UTF-8 encoded JSON bytes"""
+    if ORJSON_AVAILABLE:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            # orjson rejects lone surrogates, non-str keys and ints wider
+            # than 64 bits, all of which stdlib json accepts
+            pass
+    return json.dumps(obj).encode('utf-8')
+
+# Protocol markers, kept as bytes so frames are built without text encoding
+_OUTPUT_PREFIX = b'LOTUS_OUTPUT:'
+_BINARY_PREFIX = b'LOTUS_BINARY:'
+_CLEAR_FRAME = b'LOTUS_CLEAR\n'
+
+# Frames are only coalesced inside display.batch(), which queues them on an
+# _OrderedStdout until _BATCH_THRESHOLD bytes are pending or the block exits
+_BATCH_THRESHOLD = 64 * 1024
+
+class _OrderedStdout:
+    """
+    Wrapper installed over sys.stdout by LotusDisplay.batch().
+    Queues encoded frames for the wrapped stream and writes them before any
+    text, so batched outputs and print() output keep their order.
+    Everything else is delegated to the stream.
+    """
+    def __init__(self, stream):
+        self._stream = stream
+        self._emit_buffer = []
+        self._emit_buffer_size = 0
+
+    def queue_frame(self, frame):
+        """Queue a frame, writing the batch once it reaches the threshold"""
+        self._emit_buffer.append(frame)
+        self._emit_buffer_size += len(frame)
+        if self._emit_buffer_size >= _BATCH_THRESHOLD:
+            self.flush_frames()
+
+    def flush_frames(self):
+        """Write all queued frames to the wrapped stream in a single call"""
+        if not self._emit_buffer:
+            return
+        data = b''.join(self._emit_buffer)
+        self._emit_buffer.clear()
+        self._emit_buffer_size = 0
+        _write_bytes(self._stream, data)
+        self._stream.flush()
+
+    def write(self, text):
+        if self._emit_buffer:
+            self.flush_frames()
+        return self._stream.write(text)
+
+    def writelines(self, lines):
+        if self._emit_buffer:
+            self.flush_frames()
+        return self._stream.writelines(lines)
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+def _write_bytes(stream, data):
+    """
+    Write encoded bytes to a stream in a single call, through the text layer
+    when it has no binary buffer (e.g. the executor's capture object).
+    """
+    buffer = getattr(stream, 'buffer', None)
+    if buffer is None:
+        stream.write(data.decode('utf-8'))
+        return
+    # Flush pending text first so bytes land after earlier print() output
+    stream.flush()
+    buffer.write(data)
+
+def _write_frame(frame):
+    """
+    Write an encoded protocol frame to stdout.
+    Inside display.batch() the frame is queued for the batched stream;
+    anywhere else it is written immediately.
+    """
+    stream = sys.stdout
+    if isinstance(stream, _OrderedStdout):
+        stream.queue_frame(frame)
+    else:
+        _write_bytes(stream, frame)
+
+def _flush_frames():
+    """Write any frames queued for the current stdout"""
+    stream = sys.stdout
+    if isinstance(stream, _OrderedStdout):
+        stream.flush_frames()
+
 # Output types for rich display
 class LotusOutput:
     """Class to represent different output types"""
@@ -37,6 +157,97 @@ class LotusOutput:
     ERROR = "error"
     RICH = "rich"
 
+# Output type groups, frozen once for constant-time membership checks
+_VALID_OUTPUT_TYPES = frozenset({
+    LotusOutput.TEXT, LotusOutput.HTML, LotusOutput.MARKDOWN, LotusOutput.SVG,
+    LotusOutput.PNG, LotusOutput.JPEG, LotusOutput.TABLE, LotusOutput.JSON,
+    LotusOutput.ERROR, LotusOutput.RICH,
+})
+_IMAGE_OUTPUT_TYPES = frozenset({LotusOutput.PNG, LotusOutput.JPEG})
+_TRUNCATABLE_OUTPUT_TYPES = frozenset({LotusOutput.HTML, LotusOutput.TABLE})
+
+# Rich representation methods probed by LotusDisplay.display, in priority order
+_REPRS = (
+    ('_repr_html_', LotusOutput.HTML),
+    ('_repr_svg_', LotusOutput.SVG),
+    ('_repr_markdown_', LotusOutput.MARKDOWN),
+    ('_repr_json_', LotusOutput.JSON),
+    ('_repr_png_', LotusOutput.PNG),
+    ('_repr_jpeg_', LotusOutput.JPEG),
+)
+
+# Resolved (method, output type) per displayed type, or None for plain repr.
+# Only types whose instances can't add or synthesize attributes are cached;
+# for others the class lookup isn't authoritative
+_repr_cache = weakref.WeakKeyDictionary()
+_MISSING = object()
+
+def _find_repr(obj):
+    """Find the first rich representation method available on an object"""
+    for method, output_type in _REPRS:
+        if getattr(obj, method, None) is not None:
+            return method, output_type
+    return None
+
+def _repr_is_static(cls):
+    """
+    Whether a type's rich representation methods can be resolved on the class:
+    its instances have no __dict__ and no custom attribute lookup.
+    """
+    return (not getattr(cls, '__dictoffset__', 0) and
+            getattr(cls, '__getattr__', None) is None and
+            not isinstance(cls.__getattribute__, types.FunctionType))
+
+# Largest output content sent as-is; bigger outputs are truncated or downscaled
+# before serialization. Measured with len(), so this is an approximate limit in
+# characters for text and base64 content, and in bytes for raw image data
+_MAX_OUTPUT_BYTES = 2 * 1024 * 1024
+
+def set_max_output_bytes(limit):
+    """Set the size above which outputs are truncated or downscaled"""
+    global _MAX_OUTPUT_BYTES
+    _MAX_OUTPUT_BYTES = int(limit)
+
+def _shrink_image(content, output_type, limit):
+    """
+    Downscale a PNG/JPEG image until len() of the result fits within limit.
+    Accepts raw or base64-encoded data and returns the same form.
+    Gives up after a few passes and returns the smallest attempt.
+    Returns the content unchanged if Pillow is not available.
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        return content
+
+    is_base64 = isinstance(content, str)
+    try:
+        raw = _b64.b64decode(content) if is_base64 else content
+        img = Image.open(io.BytesIO(raw))
+        img.load()
+    except Exception:
+        return content
+
+    result = content
+    scale = 1.0
+    for _ in range(8):
+        # Encoded size scales roughly with pixel count; aim a little under
+        scale *= 0.9 * (limit / len(result)) ** 0.5
+        width = max(1, int(img.width * scale))
+        height = max(1, int(img.height * scale))
+        try:
+            buf = io.BytesIO()
+            img.resize((width, height)).save(
+                buf, format='PNG' if output_type == LotusOutput.PNG else 'JPEG')
+        except Exception:
+            return result
+
+        data = buf.getvalue()
+        result = _b64.b64encode(data).decode('ascii') if is_base64 else data
+        if len(result) <= limit or (width == 1 and height == 1):
+            break
+    return result
+
 class LotusDisplay:
     """
     Class for rich display in Lotus Notebook.
@@ -54,33 +265,123 @@ class LotusDisplay:
                 return self._create_output(LotusOutput.HTML, obj)
             else:
                 return self._create_output(LotusOutput.TEXT, obj)
-        elif hasattr(obj, '_repr_html_'):
-            return self._create_output(LotusOutput.HTML, obj._repr_html_())
-        elif hasattr(obj, '_repr_svg_'):
-            return self._create_output(LotusOutput.SVG, obj._repr_svg_())
-        elif hasattr(obj, '_repr_markdown_'):
-            return self._create_output(LotusOutput.MARKDOWN, obj._repr_markdown_())
-        elif hasattr(obj, '_repr_json_'):
-            return self._create_output(LotusOutput.JSON, json.dumps(obj._repr_json_()))
-        elif hasattr(obj, '_repr_png_'):
-            return self._create_output(LotusOutput.PNG, obj._repr_png_())
-        elif hasattr(obj, '_repr_jpeg_'):
-            return self._create_output(LotusOutput.JPEG, obj._repr_jpeg_())
-        else:
+
+        # Resolve the representation method once per type where possible,
+        # otherwise probe the instance itself
+        cls = type(obj)
+        entry = _repr_cache.get(cls, _MISSING)
+        if entry is _MISSING:
+            if _repr_is_static(cls):
+                entry = _find_repr(cls)
+                _repr_cache[cls] = entry
+            else:
+                entry = _find_repr(obj)
+
+        if entry is None:
             return self._create_output(LotusOutput.TEXT, repr(obj))
 
+        method, output_type = entry
+        content = getattr(obj, method)()
+        if output_type == LotusOutput.JSON:
+            return self._create_output(output_type, _dumps(content).decode('utf-8'))
+        elif output_type in _IMAGE_OUTPUT_TYPES:
+            return self._emit_binary(output_type, content)
+        return self._create_output(output_type, content)
+
     def _create_output(self, output_type, content):
         """Create output dictionary"""
+        if output_type not in _VALID_OUTPUT_TYPES:
+            raise ValueError(f"Unknown output type: {output_type}")
+        if isinstance(content, (str, bytes)) and len(content) > _MAX_OUTPUT_BYTES:
+            content = self._limit_output(output_type, content)
+
         output = {
             'type': output_type,
             'content': content
         }
-        print(f"LOTUS_OUTPUT:{json.dumps(output)}")
+        _write_frame(b''.join((_OUTPUT_PREFIX, _dumps(output), b'\n')))
         return output
 
+    def _emit_binary(self, output_type, raw_bytes):
+        """
+        Emit raw image bytes as a LOTUS_BINARY:<type>:<len> header line followed
+        by the payload, skipping base64 and JSON encoding entirely.
+        Falls back to a base64 LOTUS_OUTPUT frame when stdout has no binary buffer.
+        """
+        if isinstance(raw_bytes, tuple):
+            # IPython's (data, metadata) form
+            raw_bytes = raw_bytes[0]
+        if raw_bytes is None or isinstance(raw_bytes, str):
+            # Declined repr, or already base64-encoded
+            return self._create_output(output_type, raw_bytes)
+
+        if len(raw_bytes) > _MAX_OUTPUT_BYTES:
+            raw_bytes = _shrink_image(raw_bytes, output_type, _MAX_OUTPUT_BYTES)
+
+        stream = sys.stdout
+        buffer = getattr(stream, 'buffer', None)
+        if buffer is None:
+            return self._create_output(output_type, _b64.b64encode(raw_bytes).decode('ascii'))
+
+        # Flush queued frames and pending text first so outputs stay ordered
+        _flush_frames()
+        stream.flush()
+        buffer.write(b'%s%s:%d\n' % (_BINARY_PREFIX, output_type.encode('ascii'), len(raw_bytes)))
+        buffer.write(raw_bytes)
+        buffer.flush()
+        return {
+            'type': output_type,
+            'content': raw_bytes
+        }
+
+    def _limit_output(self, output_type, content):
+        """Truncate or downscale content larger than the output limit"""
+        limit = _MAX_OUTPUT_BYTES
+        if output_type in _TRUNCATABLE_OUTPUT_TYPES:
+            # Cut after the last complete tag so the footer isn't swallowed
+            # into a half-written tag or attribute
+            cut = content.rfind('>', 0, limit) + 1
+            if cut <= 0:
+                cut = limit
+            omitted = len(content) - cut
+            return (content[:cut] +
+                    f'<div class="lotus-output-truncated">... (truncated, {omitted} characters omitted) ...</div>')
+        elif output_type in _IMAGE_OUTPUT_TYPES:
+            return _shrink_image(content, output_type, limit)
+        return content
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Coalesce the outputs displayed inside the block into as few writes
+        as possible, e.g. for a loop that displays many small outputs.
+        Queued outputs are written before any printed text, on flush(), and
+        when the block exits.
+        """
+        if isinstance(sys.stdout, _OrderedStdout):
+            # Already batching
+            yield
+            return
+
+        stream = _OrderedStdout(sys.stdout)
+        sys.stdout = stream
+        try:
+            yield
+        finally:
+            stream.flush_frames()
+            if sys.stdout is stream:
+                sys.stdout = stream._stream
+
+    def flush(self):
+        """
+        Write any queued outputs to stdout.
+        Called by the executor at the end of each cell.
+        """
+        _flush_frames()
+
     def clear(self):
         """Clear the display"""
-        print("LOTUS_CLEAR")
+        _write_frame(_CLEAR_FRAME)
 
 # Global display instance
 display = LotusDisplay()
@@ -95,35 +396,80 @@ def setup_lotus_environment():
     print(f"Python Version: {sys.version}")
     print()
 
-    # Check available libraries
-    try:
-        import numpy
-        print(f"NumPy Version: {numpy.__version__}")
-    except ImportError:
-        print("NumPy: Not available")
-
-    try:
-        import pandas
-        print(f"Pandas Version: {pandas.__version__}")
-    except ImportError:
-        print("Pandas: Not available")
-
-    try:
-        import matplotlib
-        print(f"Matplotlib Version: {matplotlib.__version__}")
-    except ImportError:
-        print("Matplotlib: Not available")
-
-    try:
-        import sklearn
-        print(f"Scikit-learn Version: {sklearn.__version__}")
-    except ImportError:
-        print("Scikit-learn: Not available")
+    # Check available libraries from package metadata, without importing them
+    for dist_name, label in (('numpy', 'NumPy'), ('pandas', 'Pandas'),
+                             ('matplotlib', 'Matplotlib'), ('scikit-learn', 'Scikit-learn')):
+        try:
+            print(f"{label} Version: {importlib.metadata.version(dist_name)}")
+        except importlib.metadata.PackageNotFoundError:
+            print(f"{label}: Not available")
 
     print()
     print("Type your Python code below and press Ctrl+Enter to execute.")
     print("Use %timeit for timing, %run for running scripts, etc.")
 
+# Cell and row separators for escaping a whole table body at once; neither
+# is touched by html.escape
+_CELL_SEP = '\x1f'
+_ROW_SEP = '\x1e'
+
+def _table_body(rows):
+    """
+    Build escaped <tr>/<td> markup for rows of cell strings.
+    The cells are joined with separator characters and escaped in a single
+    html.escape pass over the whole body, rather than one call per cell.
+    """
+    flat = _ROW_SEP.join(_CELL_SEP.join(row) for row in rows)
+    width = len(rows[0]) if rows else 0
+    if (flat.count(_CELL_SEP) != len(rows) * (width - 1) or
+            flat.count(_ROW_SEP) != len(rows) - 1):
+        # Some cell contains a separator character; escape cell by cell
+        escape = html_module.escape
+        return ''.join('<tr>' + ''.join(f'<td>{escape(v, quote=False)}</td>' for v in row) + '</tr>'
+                       for row in rows)
+
+    flat = html_module.escape(flat, quote=False)
+    return ('<tr><td>' +
+            flat.replace(_CELL_SEP, '</td><td>').replace(_ROW_SEP, '</td></tr><tr><td>') +
+            '</td></tr>')
+
+# DataFrames bigger than this are shown as head/tail rows and leading/trailing
+# columns only
+_DF_MAX_ROWS = 200
+_DF_MAX_COLS = 50
+
+def _format_large_dataframe(df, pd):
+    """
+    Format a large DataFrame as a truncated HTML table, building the markup
+    directly from the cell strings instead of going through DataFrame.to_html.
+    """
+    n_rows, n_cols = df.shape
+    half_rows = _DF_MAX_ROWS // 2
+    half_cols = _DF_MAX_COLS // 2
+    cut_rows = n_rows > _DF_MAX_ROWS
+    cut_cols = n_cols > _DF_MAX_COLS
+
+    if cut_rows:
+        df = pd.concat([df.head(half_rows), df.tail(half_rows)])
+    if cut_cols:
+        df = pd.concat([df.iloc[:, :half_cols], df.iloc[:, -half_cols:]], axis=1)
+
+    headers = [str(col) for col in df.columns]
+    # Stringify cells directly: astype(str) leaves missing values as float NaN
+    # on newer pandas
+    rows = [['NaN' if isinstance(v, float) and v != v else str(v) for v in row]
+            for row in df.to_numpy(dtype=object).tolist()]
+    if cut_rows:
+        rows.insert(half_rows, ['...'] * len(headers))
+    if cut_cols:
+        headers = headers[:half_cols] + ['...'] + headers[half_cols:]
+        rows = [row[:half_cols] + ['...'] + row[half_cols:] for row in rows]
+
+    header = ''.join(f'<th>{html_module.escape(col, quote=False)}</th>' for col in headers)
+    return ''.join(('<table border="0" class="dataframe lotus-dataframe"><thead><tr>', header,
+                    '</tr></thead><tbody>', _table_body(rows),
+                    f'</tbody></table><p>{n_rows} rows × {n_cols} columns</p>'))
+
 def format_dataframe(df):
     """
     Format a pandas DataFrame as an HTML table.
@@ -138,6 +484,10 @@ def format_dataframe(df):
                 'dtypes': {col: str(dtype) for col, dtype in df.dtypes.items()}
             }
 
+            # Large frames skip pandas' per-cell HTML writer
+            if df.shape[0] > _DF_MAX_ROWS or df.shape[1] > _DF_MAX_COLS:
+                return _format_large_dataframe(df, pd)
+
             # Format as HTML with styling
             html = df.to_html(classes='lotus-dataframe', index=False, border=0)
             return html
@@ -163,22 +513,48 @@ def format_series(series):
         pass
     return None
 
+# Whether the Agg backend has been selected yet
+_AGG_CONFIGURED = False
+
+def _import_pyplot():
+    """
+    Import matplotlib.pyplot, configuring the Agg backend for inline display
+    on first use so kernel startup does not pay for the matplotlib import.
+    """
+    global _AGG_CONFIGURED
+    if not _AGG_CONFIGURED:
+        import matplotlib
+        matplotlib.use('Agg')
+        _AGG_CONFIGURED = True
+    import matplotlib.pyplot as plt
+    return plt
+
+# Reusable buffers for PNG and SVG plot captures
+_PNG_BUF = io.BytesIO()
+_SVG_BUF = io.StringIO()
+
+def _save_plot_png(plt):
+    """Save the current figure into the shared PNG buffer and return it"""
+    # Reset from any previous capture
+    buf = _PNG_BUF
+    buf.seek(0)
+    buf.truncate()
+    plt.savefig(buf, format='png', bbox_inches='tight', dpi=100)
+    return buf
+
 def capture_plot():
     """
     Capture the current matplotlib figure and return as base64-encoded PNG.
     This function is called by the C++ executor to get plot images.
     """
     try:
-        import matplotlib.pyplot as plt
-        from io import BytesIO
+        plt = _import_pyplot()
 
-        # Save figure to buffer
-        buf = BytesIO()
-        plt.savefig(buf, format='png', bbox_inches='tight', dpi=100)
-        buf.seek(0)
+        buf = _save_plot_png(plt)
 
-        # Encode to base64
-        img_base64 = base64.b64encode(buf.read()).decode('utf-8')
+        # Encode to base64 straight from the buffer's memory
+        with buf.getbuffer() as data:
+            img_base64 = _b64.b64encode(data).decode('utf-8')
 
         # Clear the figure
         plt.clf()
@@ -189,20 +565,38 @@ def capture_plot():
     except Exception as e:
         return None
 
+def emit_plot():
+    """
+    Capture the current matplotlib figure and emit it as a binary PNG output.
+    """
+    try:
+        plt = _import_pyplot()
+
+        raw = _save_plot_png(plt).getvalue()
+
+        # Clear the figure
+        plt.clf()
+        plt.cla()
+        plt.close('all')
+
+        return display._emit_binary(LotusOutput.PNG, raw)
+    except Exception as e:
+        return None
+
 def capture_svg():
     """
     Capture the current matplotlib figure as SVG.
     """
     try:
-        import matplotlib.pyplot as plt
-        from io import StringIO
+        plt = _import_pyplot()
 
-        # Save figure to buffer
-        buf = StringIO()
-        plt.savefig(buf, format='svg', bbox_inches='tight')
+        # Save figure to the shared buffer, reset from any previous capture
+        buf = _SVG_BUF
         buf.seek(0)
+        buf.truncate()
+        plt.savefig(buf, format='svg', bbox_inches='tight')
 
-        svg_content = buf.read()
+        svg_content = buf.getvalue()
 
         # Clear the figure
         plt.clf()
@@ -218,27 +612,117 @@ def clear_plots():
     Clear all current matplotlib figures.
     """
     try:
-        import matplotlib.pyplot as plt
+        plt = _import_pyplot()
         plt.clf()
         plt.cla()
         plt.close('all')
     except:
         pass
 
-def format_exception(error):
-    """
-    Format an exception with syntax highlighting for traceback.
-    Returns HTML-formatted error message.
-    """
-    html = f"""
+# HTML layout for format_exception: error message, then traceback
+_ERROR_TEMPLATE = """
     <div class="lotus-error">
-        <div class="lotus-error-type">{type(error).__name__}: {str(error)}</div>
+        <div class="lotus-error-type">%s</div>
         <pre class="lotus-traceback">
-{traceback.format_exc()}
+%s
         </pre>
     </div>
     """
-    return html
+
+def format_exception(error):
+    """
+    Format an exception with syntax highlighting for traceback.
+    Returns HTML-formatted error message.
+    """
+    tb_str = ''.join(traceback_module.TracebackException.from_exception(error).format())
+    message = f"{type(error).__name__}: {error}"
+    return _ERROR_TEMPLATE % (html_module.escape(message), html_module.escape(tb_str))
+
+# Stylesheet prepended to every rendered markdown output
+_MD_STYLE = '''\
+<style>
+    .lotus-markdown-content {
+        font-family: Arial, sans-serif;
+        font-size: 12px;
+        line-height: 1.6;
+        color: #333;
+    }
+    .lotus-markdown-content h1 {
+        font-size: 24px;
+        border-bottom: 1px solid #e0e0e0;
+        padding-bottom: 8px;
+        margin-bottom: 16px;
+    }
+    .lotus-markdown-content h2 {
+        font-size: 20px;
+        border-bottom: 1px solid #e0e0e0;
+        padding-bottom: 6px;
+        margin-bottom: 14px;
+    }
+    .lotus-markdown-content h3 {
+        font-size: 16px;
+        margin-bottom: 12px;
+    }
+    .lotus-markdown-content pre {
+        background-color: #f5f5f5;
+        padding: 12px;
+        border-radius: 4px;
+        overflow-x: auto;
+    }
+    .lotus-markdown-content code {
+        background-color: #f5f5f5;
+        padding: 2px 6px;
+        border-radius: 3px;
+        font-family: 'Fira Code', monospace;
+        font-size: 11px;
+    }
+    .lotus-markdown-content pre code {
+        background-color: transparent;
+        padding: 0;
+    }
+    .lotus-markdown-content blockquote {
+        border-left: 4px solid #2E7D32;
+        margin: 0;
+        padding-left: 16px;
+        color: #666;
+    }
+    .lotus-markdown-content a {
+        color: #1976d2;
+        text-decoration: none;
+    }
+    .lotus-markdown-content hr {
+        border: none;
+        border-top: 1px solid #e0e0e0;
+        margin: 16px 0;
+    }
+    .lotus-markdown-content table {
+        border-collapse: collapse;
+        width: 100%;
+    }
+    .lotus-markdown-content th, .lotus-markdown-content td {
+        border: 1px solid #e0e0e0;
+        padding: 8px 12px;
+        text-align: left;
+    }
+    .lotus-markdown-content th {
+        background-color: #f5f5f5;
+    }
+    .lotus-markdown-content img {
+        max-width: 100%;
+    }
+</style>
+'''
+
+# Shared markdown converter with extensions, built once at import
+if MARKDOWN_AVAILABLE:
+    _MD = markdown.Markdown(
+        extensions=['fenced_code', 'tables', 'codehilite', 'nl2br'],
+        extension_configs={
+            'codehilite': {
+                'css_class': 'highlight'
+            }
+        }
+    )
 
 def render_markdown(text):
     """
@@ -250,146 +734,82 @@ def render_markdown(text):
         # Fallback: simple text with basic formatting
         html = _simple_markdown_render(text)
     else:
-        # Use full markdown library with extensions
-        md = markdown.Markdown(
-            extensions=['fenced_code', 'tables', 'codehilite', 'nl2br'],
-            extension_configs={
-                'codehilite': {
-                    'css_class': 'highlight'
-                }
-            }
-        )
-        html = md.convert(text)
+        # Use the shared markdown converter, clearing state from the last render
+        html = _MD.reset().convert(text)
 
     # Wrap in container with styling
-    styled_html = f'''
-    <style>
-        .lotus-markdown-content {{
-            font-family: Arial, sans-serif;
-            font-size: 12px;
-            line-height: 1.6;
-            color: #333;
-        }}
-        .lotus-markdown-content h1 {{
-            font-size: 24px;
-            border-bottom: 1px solid #e0e0e0;
-            padding-bottom: 8px;
-            margin-bottom: 16px;
-        }}
-        .lotus-markdown-content h2 {{
-            font-size: 20px;
-            border-bottom: 1px solid #e0e0e0;
-            padding-bottom: 6px;
-            margin-bottom: 14px;
-        }}
-        .lotus-markdown-content h3 {{
-            font-size: 16px;
-            margin-bottom: 12px;
-        }}
-        .lotus-markdown-content pre {{
-            background-color: #f5f5f5;
-            padding: 12px;
-            border-radius: 4px;
-            overflow-x: auto;
-        }}
-        .lotus-markdown-content code {{
-            background-color: #f5f5f5;
-            padding: 2px 6px;
-            border-radius: 3px;
-            font-family: 'Fira Code', monospace;
-            font-size: 11px;
-        }}
-        .lotus-markdown-content pre code {{
-            background-color: transparent;
-            padding: 0;
-        }}
-        .lotus-markdown-content blockquote {{
-            border-left: 4px solid #2E7D32;
-            margin: 0;
-            padding-left: 16px;
-            color: #666;
-        }}
-        .lotus-markdown-content a {{
-            color: #1976d2;
-            text-decoration: none;
-        }}
-        .lotus-markdown-content hr {{
-            border: none;
-            border-top: 1px solid #e0e0e0;
-            margin: 16px 0;
-        }}
-        .lotus-markdown-content table {{
-            border-collapse: collapse;
-            width: 100%;
-        }}
-        .lotus-markdown-content th, .lotus-markdown-content td {{
-            border: 1px solid #e0e0e0;
-            padding: 8px 12px;
-            text-align: left;
-        }}
-        .lotus-markdown-content th {{
-            background-color: #f5f5f5;
-        }}
-        .lotus-markdown-content img {{
-            max-width: 100%;
-        }}
-    </style>
-    <div class="lotus-markdown-content">{html}</div>
-    '''
-
-    output = {{
-        'type': 'markdown',
-        'content': styled_html
-    }}
-    print(f"LOTUS_OUTPUT:{{json.dumps(output)}}")
-    return output
+    styled_html = ''.join((_MD_STYLE, '<div class="lotus-markdown-content">', html, '</div>'))
 
-def _simple_markdown_render(text):
-    """
-    Simple markdown-like rendering for when markdown library is not available.
-    """
-    html = text
-
-    # Escape HTML
-    html = html.replace("&", "&amp;")
-    html = html.replace("<", "&lt;")
-    html = html.replace(">", "&gt;")
+    return display._create_output(LotusOutput.MARKDOWN, styled_html)
 
-    # Headers
-    html = re.sub(r'^###### (.+)$', r'<h6>\1</h6>', html, flags=re.MULTILINE)
-    html = re.sub(r'^##### (.+)$', r'<h5>\1</h5>', html, flags=re.MULTILINE)
-    html = re.sub(r'^#### (.+)$', r'<h4>\1</h4>', html, flags=re.MULTILINE)
-    html = re.sub(r'^### (.+)$', r'<h3>\1</h3>', html, flags=re.MULTILINE)
-    html = re.sub(r'^## (.+)$', r'<h2>\1</h2>', html, flags=re.MULTILINE)
-    html = re.sub(r'^# (.+)$', r'<h1>\1</h1>', html, flags=re.MULTILINE)
+# HTML escape table for the fallback markdown renderer
+_HTML_ESCAPE_TABLE = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;'})
 
-    # Bold
-    html = re.sub(r'\*\*(.+?)\*\*', r'<strong>\1</strong>', html)
-    html = re.sub(r'__(.+?)__', r'<strong>\1</strong>', html)
+# Line-anchored rules for the fallback markdown renderer, unioned into a
+# single alternation so each render scans the text once
+_MD_LINE_RE = re.compile(
+    r'^(?:(?P<header>#{1,6}) (?P<header_text>.+)'   # Headers
+    r'|(?:[*-]|\d+\.) (?P<item>.+)'                  # Lists
+    r'|(?P<hr>---+)'                                # Horizontal rules
+    r'|&gt; (?P<quote>.+))$',                       # Blockquotes (already escaped)
+    re.MULTILINE
+)
 
-    # Italic
-    html = re.sub(r'\*(.+?)\*', r'<em>\1</em>', html)
-    html = re.sub(r'_(.+?)_', r'<em>\1</em>', html)
+# Inline rules for the fallback markdown renderer; earlier alternatives win,
+# so code spans are matched before emphasis. A single * or _ only opens or
+# closes italics next to non-space text, and _ never inside a word, so stray
+# markers (2 * 3, snake_case) don't swallow the bold that follows them
+_MD_INLINE_RE = re.compile(
+    r'```\w*\n(?P<block>[\s\S]+?)```'                    # Code blocks
+    r'|`(?P<code>.+?)`'                                   # Inline code
+    r'|\*\*\*(?P<strong_em>.+?)\*\*\*|___(?P<strong_em_u>.+?)___'  # Bold italic
+    r'|\*\*(?P<strong>.+?)\*\*|__(?P<strong_u>.+?)__'      # Bold
+    r'|\*(?!\s)(?P<em>.+?)(?<!\s)\*'                      # Italic
+    r'|(?<!\w)_(?!\s)(?P<em_u>.+?)(?<!\s)_(?!\w)'
+    r'|\[(?P<link>[^\]]+)\]\((?P<href>[^)]+)\)'           # Links
+)
 
-    # Code blocks
-    html = re.sub(r'```(\w*)\n([\s\S]+?)```', r'<pre><code>\2</code></pre>', html)
-
-    # Inline code
-    html = re.sub(r'`(.+?)`', r'<code>\1</code>', html)
+def _md_line_sub(match):
+    """Render a single line-anchored markdown construct"""
+    kind = match.lastgroup
+    if kind == 'header_text':
+        level = len(match.group('header'))
+        return f'<h{level}>{match.group(kind)}</h{level}>'
+    elif kind == 'item':
+        return f'<li>{match.group(kind)}</li>'
+    elif kind == 'hr':
+        return '<hr>'
+    else:
+        return f'<blockquote>{match.group(kind)}</blockquote>'
 
-    # Lists
-    html = re.sub(r'^\* (.+)$', r'<li>\1</li>', html, flags=re.MULTILINE)
-    html = re.sub(r'^- (.+)$', r'<li>\1</li>', html, flags=re.MULTILINE)
-    html = re.sub(r'^\d+\. (.+)$', r'<li>\1</li>', html, flags=re.MULTILINE)
+def _md_inline_sub(match):
+    """Render a single inline markdown construct, recursing into nested text"""
+    kind = match.lastgroup
+    if kind == 'block':
+        return f'<pre><code>{match.group(kind)}</code></pre>'
+    elif kind == 'code':
+        return f'<code>{match.group(kind)}</code>'
+    elif kind == 'href':
+        text = _MD_INLINE_RE.sub(_md_inline_sub, match.group('link'))
+        return f'<a href="{match.group(kind)}">{text}</a>'
 
-    # Links
-    html = re.sub(r'\[([^\]]+)\]\(([^)]+)\)', r'<a href="\2">\1</a>', html)
+    text = _MD_INLINE_RE.sub(_md_inline_sub, match.group(kind))
+    if kind in ('strong_em', 'strong_em_u'):
+        return f'<strong><em>{text}</em></strong>'
+    elif kind in ('strong', 'strong_u'):
+        return f'<strong>{text}</strong>'
+    return f'<em>{text}</em>'
 
-    # Horizontal rules
-    html = re.sub(r'^---+$', r'<hr>', html, flags=re.MULTILINE)
+def _simple_markdown_render(text):
+    """
+    Simple markdown-like rendering for when markdown library is not available.
+    """
+    # Escape HTML
+    html = text.translate(_HTML_ESCAPE_TABLE)
 
-    # Blockquotes
-    html = re.sub(r'^> (.+)$', r'<blockquote>\1</blockquote>', html, flags=re.MULTILINE)
+    # Block-level constructs, then inline formatting
+    html = _MD_LINE_RE.sub(_md_line_sub, html)
+    html = _MD_INLINE_RE.sub(_md_inline_sub, html)
 
     # Paragraphs
     paragraphs = html.split('\n\n')
@@ -405,36 +825,137 @@ def pretty_format(obj, max_depth=3, indent=2):
     """
     Pretty print a Python object with syntax highlighting.
     """
-    def _format(obj, depth=0):
+    def _format(obj, depth, out):
+        # Appends fragments to out; joined once by the caller
         if depth > max_depth:
-            return "..."
+            out.append("...")
+            return
 
         if isinstance(obj, dict):
-            items = []
+            out.append("{")
+            first = True
             for k, v in obj.items():
-                items.append(f'"{k}": {_format(v, depth+1)}')
-            return "{" + ", ".join(items) + "}"
+                if not first:
+                    out.append(", ")
+                first = False
+                out.append(f'"{k}": ')
+                _format(v, depth+1, out)
+            out.append("}")
         elif isinstance(obj, (list, tuple)):
-            items = [_format(v, depth+1) for v in obj]
-            if isinstance(obj, tuple):
-                return "(" + ", ".join(items) + ")"
-            else:
-                return "[" + ", ".join(items) + "]"
+            is_tuple = isinstance(obj, tuple)
+            out.append("(" if is_tuple else "[")
+            first = True
+            for v in obj:
+                if not first:
+                    out.append(", ")
+                first = False
+                _format(v, depth+1, out)
+            out.append(")" if is_tuple else "]")
         elif isinstance(obj, str):
-            return f'"{obj}"'
+            out.append(f'"{obj}"')
         elif isinstance(obj, bool):
-            return "True" if obj else "False"
+            out.append("True" if obj else "False")
         elif obj is None:
-            return "None"
+            out.append("None")
         elif hasattr(obj, '__repr__'):
             result = repr(obj)
-            if len(result) > 100:
-                result = result[:97] + "..."
-            return result
+            out.append(result if len(result) <= 100 else result[:97] + "...")
         else:
-            return str(obj)
+            out.append(str(obj))
+
+    buf = []
+    _format(obj, 0, buf)
+    return "".join(buf)
+
+# On-disk store for IPythonMagic.cache and @lotus_cache results
+_CACHE_DIR = Path('~/.lotus/cache').expanduser()
+
+def _cache_path(digest):
+    """Path of the cache file for a digest"""
+    return _CACHE_DIR / (digest + ('.pkl.zst' if ZSTANDARD_AVAILABLE else '.pkl'))
+
+def _cache_load(path):
+    """Load a cached value, or return _MISSING if there is no usable entry"""
+    import pickle
+    try:
+        data = path.read_bytes()
+        if ZSTANDARD_AVAILABLE:
+            data = zstandard.ZstdDecompressor().decompress(data)
+        return pickle.loads(data)
+    except Exception:
+        # Missing, corrupt or incompatible entry; recompute and overwrite it
+        return _MISSING
+
+def _cache_store(path, value):
+    """Pickle a value to the cache, replacing any existing entry atomically"""
+    import pickle
+    try:
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if ZSTANDARD_AVAILABLE:
+            data = zstandard.ZstdCompressor().compress(data)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + '.tmp')
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+    except Exception as e:
+        print(f"Note: could not cache results: {e}")
+
+def lotus_cache(func):
+    """
+    Decorator that caches a function's return values on disk, keyed on its
+    source and pickled arguments, so results survive kernel restarts.
+    """
+    import inspect
+    import marshal
+
+    try:
+        source = inspect.getsource(func).encode('utf-8')
+    except (OSError, TypeError):
+        # Defined in a notebook cell; fall back to the compiled code
+        source = marshal.dumps(func.__code__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        import hashlib
+        import pickle
 
-    return _format(obj)
+        try:
+            key = pickle.dumps((args, sorted(kwargs.items())), protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            # Unpicklable arguments can't be cached
+            return func(*args, **kwargs)
+
+        path = _cache_path(hashlib.blake2b(source + key).hexdigest())
+        result = _cache_load(path)
+        if result is _MISSING:
+            result = func(*args, **kwargs)
+            _cache_store(path, result)
+        return result
+
+    return wrapper
+
+def _code_inputs(code, inputs, assigned, top=True):
+    """
+    Collect the names a code object reads before binding them itself.
+    Only top-level stores count as bindings; nested bodies run later.
+    """
+    import dis
+    for instr in dis.get_instructions(code):
+        if instr.opname in ('LOAD_NAME', 'LOAD_GLOBAL', 'LOAD_FROM_DICT_OR_GLOBALS'):
+            if instr.argval not in assigned:
+                inputs.add(instr.argval)
+        elif top and instr.opname in ('STORE_NAME', 'STORE_GLOBAL'):
+            assigned.add(instr.argval)
+        elif isinstance(instr.argval, types.CodeType):
+            _code_inputs(instr.argval, inputs, assigned, top=False)
+
+@functools.lru_cache(maxsize=32)
+def _compile_file(path, mtime_ns, size):
+    """
+    Compile a Python file with its real filename for tracebacks.
+    Cached on (path, mtime, size) so rerunning an unchanged script skips the parser.
+    """
+    return compile(Path(path).read_bytes(), path, 'exec')
 
 # IPython-style magic commands support
 class IPythonMagic:
@@ -442,19 +963,137 @@ class IPythonMagic:
     def __init__(self):
         self._timing_results = {}
 
-    def timeit(self, code, number=1000000):
-        """Time code execution"""
+    def timeit(self, code, number=None):
+        """
+        Time code execution.
+        If number is not given, the loop count is picked like timeit.Timer.autorange,
+        growing it until the total run takes at least 0.2 seconds.
+        """
         import time
-        start = time.perf_counter()
-        for _ in range(min(number, 10000)):
-            eval(code)
-        elapsed = time.perf_counter() - start
-        return f"{elapsed:.6f} seconds"
+        co = compile(code, '<timeit>', 'eval')
+        g = globals()
+
+        def _run(n):
+            start = time.perf_counter_ns()
+            for _ in range(n):
+                eval(co, g)
+            return time.perf_counter_ns() - start
+
+        if number is None:
+            i = 1
+            while True:
+                for step in (1, 2, 5):
+                    number = i * step
+                    elapsed_ns = _run(number)
+                    if elapsed_ns >= 200_000_000:
+                        break
+                else:
+                    i *= 10
+                    continue
+                break
+        else:
+            elapsed_ns = _run(number)
+
+        # No loops ran for number < 1; report a zero timing as before
+        per_loop_ns = elapsed_ns / number if number >= 1 else 0
+        self._timing_results[code] = per_loop_ns / 1e9
+
+        # Report in the largest unit that keeps the value >= 1
+        for scale, unit in ((1e9, 's'), (1e6, 'ms'), (1e3, 'us'), (1, 'ns')):
+            if per_loop_ns >= scale:
+                break
+        return f"{per_loop_ns / scale:.3f} {unit} per loop ({max(number, 0)} loops)"
+
+    def cache(self, key, code, ns=None, names=None):
+        """
+        Run code once and cache the variables it defines on disk (like %cache).
+        Later calls with the same key, code and inputs load the variables
+        instead; the inputs are the existing variables the code reads, so
+        changing one re-runs the code. Code that reads an unpicklable input
+        always runs uncached.
+        names selects the variables to cache and is part of the key; by
+        default every variable the code assigns at top level. Modules are
+        recorded by name and re-imported on restore; variables that can't be
+        pickled or were never bound are skipped with a note. An entry that
+        can't be restored (e.g. a pickled class no longer exists) is treated
+        as a miss and the code runs again.
+        Returns the names restored or stored.
+        """
+        import hashlib
+        import pickle
+
+        if ns is None:
+            ns = globals()
+
+        compiled = compile(code, '<cache>', 'exec')
+        inputs = set()
+        assigned = set()
+        _code_inputs(compiled, inputs, assigned)
+        if names is None:
+            names = sorted(name for name in assigned if not name.startswith('__'))
+            explicit = False
+        else:
+            names = list(names)
+            explicit = True
+
+        digest = hashlib.blake2b((key + '\0' + code).encode('utf-8'))
+        digest.update(('\0'.join(['', 'names'] + sorted(names))).encode('utf-8'))
+        for name in sorted(inputs):
+            if name.startswith('__') or name not in ns:
+                continue
+            value = ns[name]
+            digest.update(b'\0' + name.encode('utf-8') + b'\0')
+            if isinstance(value, types.ModuleType):
+                digest.update(value.__name__.encode('utf-8'))
+                continue
+            try:
+                digest.update(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+            except Exception as e:
+                print(f"Note: not caching, input '{name}' can't be pickled: {e}")
+                exec(compiled, ns)
+                return ()
+
+        path = _cache_path(digest.hexdigest())
+        cached = _cache_load(path)
+        if cached is not _MISSING:
+            try:
+                blobs, modules = cached
+                restored = {name: pickle.loads(blob) for name, blob in blobs.items()}
+                for name, module_name in modules.items():
+                    restored[name] = importlib.import_module(module_name)
+            except Exception as e:
+                # Restore all or nothing so ns is never left half updated
+                print(f"Note: cached results could not be restored, re-running: {e}")
+            else:
+                ns.update(restored)
+                return tuple(blobs) + tuple(modules)
+
+        exec(compiled, ns)
+
+        blobs = {}
+        modules = {}
+        for name in names:
+            if name not in ns:
+                # Deleted again by the code, or never bound at all
+                if explicit:
+                    print(f"Note: not caching '{name}': not defined by the code")
+                continue
+            value = ns[name]
+            if isinstance(value, types.ModuleType):
+                modules[name] = value.__name__
+                continue
+            try:
+                blobs[name] = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            except Exception as e:
+                print(f"Note: not caching '{name}': {e}")
+        _cache_store(path, (blobs, modules))
+        return tuple(blobs) + tuple(modules)
 
     def run(self, filename):
         """Run a Python file"""
-        with open(filename) as f:
-            exec(f.read(), globals())
+        stat = os.stat(filename)
+        co = _compile_file(os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+        exec(co, globals())
 
 # Global magic instance
 magic = IPythonMagic()
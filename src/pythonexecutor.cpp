@@ -232,7 +232,11 @@ bool PythonExecutor::setupPlotCapture()
     const char* plotCaptureCode = R"(
 import sys
 import io
-import base64
+# Private alias: this runs in the cell namespace, where base64 must stay stdlib
+try:
+    import pybase64 as _lotus_b64
+except ImportError:
+    import base64 as _lotus_b64
 
 class PlotCapture:
     def __init__(self):
@@ -247,8 +251,7 @@ class PlotCapture:
 
             buf = BytesIO()
             plt.savefig(buf, format='png', bbox_inches='tight', dpi=100)
-            buf.seek(0)
-            img_base64 = base64.b64encode(buf.read()).decode('utf-8')
+            img_base64 = _lotus_b64.b64encode(buf.getvalue()).decode('utf-8')
             self.plot_count += 1
             return img_base64
         except Exception as e:
@@ -306,6 +309,40 @@ void PythonExecutor::capturePlot()
     Py_XDECREF(pResult);
 }
 
+void PythonExecutor::flushRuntimeOutputs()
+{
+    // Write any rich outputs still queued by lotus_runtime's display batching
+    PyObject *pName = PyUnicode_FromString("lotus_runtime");
+    if (!pName) {
+        PyErr_Clear();
+        return;
+    }
+
+    PyObject *pRuntime = PyImport_GetModule(pName);
+    Py_DECREF(pName);
+
+    if (!pRuntime) {
+        PyErr_Clear();
+        return;
+    }
+
+    PyObject *pDisplay = PyObject_GetAttrString(pRuntime, "display");
+    Py_DECREF(pRuntime);
+
+    if (!pDisplay) {
+        PyErr_Clear();
+        return;
+    }
+
+    PyObject *pResult = PyObject_CallMethod(pDisplay, "flush", NULL);
+    Py_DECREF(pDisplay);
+
+    if (!pResult) {
+        PyErr_Clear();
+    }
+    Py_XDECREF(pResult);
+}
+
 PythonExecutor::ExecutionResult PythonExecutor::execute(const QString &code)
 {
     ExecutionResult result;
@@ -430,6 +467,9 @@ PythonExecutor::ExecutionResult PythonExecutor::execute(const QString &code)
             PyErr_Clear();
         }
 
+        // Flush batched rich outputs before collecting stdout
+        flushRuntimeOutputs();
+
         // Get stdout and stderr
         if (pStdout) {
             PyObject *pOutput = PyObject_GetAttrString(pStdout, "output");
@@ -101,6 +101,7 @@ private:
     bool setupStdoutRedirection();
     bool setupPlotCapture();
     void capturePlot();
+    void flushRuntimeOutputs();
     QList<Output> parseRichOutputs(const QString &stdoutText);
 
     // Static callback functions for Python C API